@@ -1,7 +1,9 @@
+import math
+from contextlib import contextmanager
 import numpy as np
-from scipy.interpolate import interp1d
-from numba import njit
-from tqdm import tqdm
+from scipy.integrate import cumulative_trapezoid
+import numba
+from numba import njit, prange
 
 try:
     import arepo
@@ -9,64 +11,210 @@ try:
 except ModuleNotFoundError:
     HAVE_AREPO = False
 
-def rejection_sample(fn, maxval, N, xrng=[0, 1], overshoot=2., dtype=np.longdouble, fn_args={}):
-    xwidth = xrng[1] - xrng[0]
-    xstart = xrng[0]
+@contextmanager
+def _numba_threads(nthreads):
+    # temporarily run numba parallel regions on nthreads threads, None keeps the default
+    if nthreads is None:
+        yield
+        return
+
+    old_nthreads = numba.get_num_threads()
+    numba.set_num_threads(nthreads)
+    try:
+        yield
+    finally:
+        numba.set_num_threads(old_nthreads)
+
+# fast-math flags for the kernels below, leaving out nnan, ninf and afn since the
+# distribution function legitimately evaluates to inf/nan at the edges of q
+_FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'reassoc'}
+
+@njit(fastmath=_FASTMATH_FLAGS, error_model='numpy', cache=True)
+def _f_of_q_scalar(q, f_prefactor):
+    # Equation 17 of Hernquist 1990
+    qsquared = q * q
+    oneminusqsquared = 1. - qsquared
 
-    sample_list = np.array([])
+    # q * sqrt(1-q**2) * (1 - 2q**2) * (8*q**4 - 8q**2 -3)
+    term2 = q * math.sqrt(oneminusqsquared) * (oneminusqsquared - qsquared)
+    term2 *= 8. * (qsquared * qsquared - qsquared) - 3.
 
-    N_needed = np.copy(N)
+    # (3 * arcsin(q) + term2) * (1-q**2)**(-5/2)
+    ans = (3. * math.asin(q) + term2) / (oneminusqsquared * oneminusqsquared * math.sqrt(oneminusqsquared))
 
-    while True:
-        x = np.random.rand(10)
-        y = np.random.rand(10)
+    return f_prefactor * ans
 
-        x *= xwidth
-        y = np.multiply(y, maxval)
+@njit(parallel=True, fastmath=_FASTMATH_FLAGS, error_model='numpy', cache=True)
+def _f_of_q(q, f_prefactor):
+    # q must be 1D, all terms are evaluated in a single pass per element
+    ans = np.empty(q.size)
+    for i in prange(q.size):
+        ans[i] = _f_of_q_scalar(q[i], f_prefactor)
 
-        fn_eval = fn(x, **fn_args)
+    return ans
 
-        if np.any(fn_eval > maxval):
-            print('maxval exceeded. maxval=', maxval, 'max of fn_eval=', np.max(fn_eval))
-            maxval = 1.5 * np.max(fn_eval)
-            continue
+@njit(fastmath=_FASTMATH_FLAGS, error_model='numpy', cache=True)
+def _g_of_q_scalar(q, g_prefactor):
+    # Equation 23 of Hernquist 1990
+    qsquared = q * q
 
-        keys = np.where(y < fn_eval)[0]
-        if len(keys)>0:
-            sample = x[keys[0]]
-            break
+    # term1 = 3 * (8 * q**4 - 4 * q**2 + 1) * np.arccos(q)
+    term1 = 3. * (8. * qsquared * qsquared - 4. * qsquared + 1.) * math.acos(q)
 
-    return sample
+    # term2 = q * (1 - q**2)**(1/2) *(4*q**2 - 1) * (2*q**2 + 3)
+    term2 = q * math.sqrt(1. - qsquared) * (4. * qsquared - 1.) * (2. * qsquared + 3.)
 
-@njit
-def _f_of_q(q, f_prefactor):
-    # Equation 17 of Hernquist 1990
-    qsquared = np.square(q)
-    oneminusqsquared = np.subtract(1., qsquared)
+    return g_prefactor * (term1 - term2) / (qsquared * qsquared * q)
 
-    # 3 * arcsin(q)
-    term1 = np.multiply(3., np.arcsin(q))
+@njit(parallel=True, fastmath=_FASTMATH_FLAGS, error_model='numpy', cache=True)
+def _g_of_q(q, g_prefactor):
+    # q must be 1D, all terms are evaluated in a single pass per element
+    ans = np.empty(q.size)
+    for i in prange(q.size):
+        ans[i] = _g_of_q_scalar(q[i], g_prefactor)
 
-    # q * sqrt(1-q**2) * (1 - 2q**2) * (8*q**4 - 8q**2 -3)
-    term2 = np.multiply(8., np.subtract(np.square(qsquared), qsquared))
-    term2 = np.subtract(term2, 3.)
-    term2 = np.multiply(np.sqrt(oneminusqsquared), term2)
-    term2 = np.multiply(q, term2)
-    term2 = np.multiply(np.subtract(oneminusqsquared, qsquared), term2)
+    return ans
+
+@njit(parallel=True, fastmath=_FASTMATH_FLAGS, error_model='numpy', cache=True)
+def _dMdE_kernel(q, f_prefactor, g_prefactor, M, vg):
+    # q must be 1D, f(q) * g(q) with the Taylor series substituted near q=0 and q=1
+    # appears to be a factor of 0.5 wrong in Hernquist 1990
+    prefactor_close_to_1 = 0.5 * (32./35.) * (M / vg**2)
+    prefactor_close_to_0 = (16./5.) * (M / vg**2)
+
+    ans = np.empty(q.size)
+    for i in prange(q.size):
+        qi = q[i]
+
+        # only evaluate the full expression away from q=0 and q=1, where it diverges
+        if qi < 1e-3:
+            ans[i] = prefactor_close_to_0 * (1. - (18./7.) * qi * qi)
+        elif 1. - qi < 1e-4:
+            ans[i] = prefactor_close_to_1 * (1. - qi * qi)
+        else:
+            ans[i] = _f_of_q_scalar(qi, f_prefactor) * _g_of_q_scalar(qi, g_prefactor)
+
+    return ans
+
+@njit(error_model='numpy', cache=True)
+def _mass_enclosed_kernel(r, M, a):
+    # M(<r) = M * r**2 / (r + a)**2
+    rplusa = r + a
+    return M * r * r / (rplusa * rplusa)
+
+@njit(parallel=True, fastmath=_FASTMATH_FLAGS, error_model='numpy', cache=True)
+def _sigmasq_kernel(r, a, GM):
+    # r must be 1D, radial velocity dispersion of the isotropic Hernquist profile
+    prefactor = GM / (12. * a)
+
+    ans = np.empty(r.size)
+    for i in prange(r.size):
+        rt = r[i] / a
+
+        # if rt > 300, revert to the analytical form for sigma sq because the numerical eqn breaks down
+        if rt > 300.:
+            ans[i] = GM / (5. * r[i])
+            continue
 
-    term1 = np.add(term1, term2)
+        oneplusrt = 1. + rt
 
-    term1 = np.multiply(term1, np.power(oneminusqsquared, -5./2.))
+        # ans1 = 12 * rt * (1+rt)**3 * np.log(1+1./rt)
+        ans1 = 12. * rt * oneplusrt * oneplusrt * oneplusrt * math.log(1. + 1. / rt)
+
+        # ans2 = (rt/(1+rt)) * (25 + 52*rt + 42*rt**2 + 12*rt**3)
+        ans2 = (rt / oneplusrt) * (25. + rt * (52. + rt * (42. + 12. * rt)))
 
-    ans = np.multiply(term1, f_prefactor)
+        ans[i] = prefactor * (ans1 - ans2)
+
+        # a nan here just indicates r=0, where the dispersion vanishes
+        if math.isnan(ans[i]) and 0. <= rt < 1e-12:
+            ans[i] = 0.
 
     return ans
 
+# particles per independently seeded block in the rejection kernels, so that draws
+# are reproducible regardless of how many threads numba uses
+_RS_BLOCKSIZE = 1024
+
+@njit(error_model='numpy', cache=True)
+def _f_of_E_scalar(E, inv_phi_of_0, f_prefactor):
+    E = min(E, -1e-8)
+    return _f_of_q_scalar(math.sqrt(E * inv_phi_of_0), f_prefactor)
+
+@njit(error_model='numpy', cache=True)
+def _maxval_scalar(r, log10rmin, dlog10r, maxval_list, pot, vmax, inv_phi_of_0, f_prefactor):
+    # bound on f(v|r) v^2, linearly interpolated from the log10(r) grid of _init_maxval_list_
+    x = (math.log10(r) - log10rmin) / dlog10r
+    if 0. <= x <= maxval_list.size - 1.:
+        idx = min(int(x), maxval_list.size - 2)
+        t = x - idx
+        return (1. - t) * maxval_list[idx] + t * maxval_list[idx + 1]
+
+    # off the grid, scan 100 speeds in [0, vmax] as the grid itself does
+    ans = 0.
+    for j in range(100):
+        v = vmax * j / 99.
+        fn_eval = v * v * _f_of_E_scalar(pot + 0.5 * v * v, inv_phi_of_0, f_prefactor)
+        if fn_eval > ans:
+            ans = fn_eval
+    return 2. * ans
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _draw_speeds_kernel(r, pot, vmax, log10rmin, dlog10r, maxval_list, inv_phi_of_0, f_prefactor, seeds):
+    # rejection samples f(v|r) v^2 on [0, vmax] for each particle, one block per seed
+    N = pot.size
+    out = np.empty(N)
+    for b in prange(seeds.size):
+        # numba keeps a separate generator per thread, so reseed it for every block
+        np.random.seed(seeds[b])
+        for i in range(b * _RS_BLOCKSIZE, min((b + 1) * _RS_BLOCKSIZE, N)):
+            this_maxval = _maxval_scalar(r[i], log10rmin, dlog10r, maxval_list, pot[i], vmax[i],
+                                         inv_phi_of_0, f_prefactor)
+            while True:
+                v = np.random.random() * vmax[i]
+                fn_eval = v * v * _f_of_E_scalar(pot[i] + 0.5 * v * v, inv_phi_of_0, f_prefactor)
+
+                if fn_eval > this_maxval:
+                    this_maxval = 1.5 * fn_eval
+                    continue
+
+                if np.random.random() * this_maxval < fn_eval:
+                    out[i] = v
+                    break
+
+    return out
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _draw_energies_kernel(pot, maxval, inv_phi_of_0, f_prefactor, seeds):
+    # rejection samples f(E) on [pot, 0] for each particle, one block per seed
+    N = pot.size
+    out = np.empty(N)
+    for b in prange(seeds.size):
+        np.random.seed(seeds[b])
+        for i in range(b * _RS_BLOCKSIZE, min((b + 1) * _RS_BLOCKSIZE, N)):
+            this_maxval = maxval[i]
+            while True:
+                E = pot[i] * (1. - np.random.random())
+                fn_eval = _f_of_E_scalar(E, inv_phi_of_0, f_prefactor)
+
+                if fn_eval > this_maxval:
+                    this_maxval = 1.5 * fn_eval
+                    continue
+
+                if np.random.random() * this_maxval < fn_eval:
+                    out[i] = E
+                    break
+
+    return out
+
 class Hernquist(object):
     def __init__(self, M, a,
-                 UnitLength_in_cm=3.085678e21, UnitMass_in_g=1.989e43, UnitVelocity_in_cm_per_s=1e5):
+                 UnitLength_in_cm=3.085678e21, UnitMass_in_g=1.989e43, UnitVelocity_in_cm_per_s=1e5,
+                 seed=None):
         self._init_units_(UnitLength_in_cm, UnitMass_in_g, UnitVelocity_in_cm_per_s)
 
+        self.rng = np.random.default_rng(seed)
+
         self.M = M
         self.a = a
 
@@ -75,30 +223,46 @@ class Hernquist(object):
         self.f_prefactor = self.M / (8. * np.sqrt(2) * np.pi**3 * self.a**3 * self.vg**3)
         self.g_prefactor = (2. * np.sqrt(2) * np.pi**2 * self.a**3 * self.vg) / (3.)
         self.phi_of_0 = - self.G * self.M / self.a
+        self._inv_phi_of_0_ = 1. / self.phi_of_0
         
         self._init_maxval_list_()
 
     def _init_maxval_list_(self, log10rmin=-6, log10rmax=4, Ngrid=int(1E4)):
-        self._r_list_ = np.logspace(log10rmin, log10rmax, Ngrid)
-        pot_list = self.potential(self._r_list_)
-        vmax_list = np.sqrt(np.multiply(2., np.abs(pot_list)))
+        self._log10r_list_ = np.linspace(log10rmin, log10rmax, Ngrid)
+        self._log10rmin_ = self._log10r_list_[0]
+        self._dlog10r_ = self._log10r_list_[1] - self._log10r_list_[0]
+        self._r_list_ = np.power(10., self._log10r_list_)
 
-        maxval_list = []
+        t, vals = self._my_f_of_vr_table_(self._r_list_)
+
+        self._maxval_list_ = np.multiply(np.nanmax(vals, axis=1), 2.)
+
+        # tabulate the cdf of v/vmax at each grid radius, which draw_speeds inverts
+        pdf = np.nan_to_num(vals, nan=0.)
+        cdf = cumulative_trapezoid(pdf, t, axis=1, initial=0)
+        self._vfrac_list_ = t
+        self._cdf_list_ = np.divide(cdf, cdf[:, -1:])
+
+    def _my_f_of_vr_table_(self, r, Nv=100):
+        # evaluate f(v|r) v^2 on Nv speeds in [0, vmax] at every r in one pass
+        vmax_list = np.sqrt(np.multiply(2., np.abs(self.potential(r))))
+
+        t = np.linspace(0, 1, Nv)
+        V = np.multiply(vmax_list[:, None], t[None, :])
+        R = np.broadcast_to(r[:, None], V.shape)
+        vals = np.reshape(self.my_f_of_vr(V.ravel(), R.ravel()), V.shape)
+
+        return t, vals
+
+    def _r_grid_index_(self, r):
+        # the grid is uniform in log10(r), so the bracketing index is computed directly
+        # instead of bisecting; r outside the grid is clamped to the endpoints
+        x = np.divide(np.subtract(np.log10(r), self._log10rmin_), self._dlog10r_)
+        x = np.clip(x, 0., len(self._r_list_) - 1.)
+        idx = np.minimum(x.astype(np.intp), len(self._r_list_) - 2)
+        t = np.subtract(x, idx)
+        return idx, t
 
-        for this_r, vmax in zip(tqdm(self._r_list_), vmax_list):
-            vlist = np.linspace(0, vmax, 100)
-            maxval = np.nanmax(pot.my_f_of_vr(vlist, this_r)) * 2
-            maxval_list.append(maxval)
-        
-        self._maxval_list_ = np.array(maxval_list)
-        
-        print(np.shape(self._r_list_))
-        print(np.shape(self._maxval_list_))
-        
-        self._maxval_interp_ = interp1d(self._r_list_, self._maxval_list_, bounds_error=False,
-                                        fill_value=(self._maxval_list_[0], self._maxval_list_[-1]))
-            
-        
     def _init_units_(self, UnitLength_in_cm, UnitMass_in_g, UnitVelocity_in_cm_per_s):
         self.UnitLength_in_cm = UnitLength_in_cm
         self.UnitMass_in_g = UnitMass_in_g
@@ -117,8 +281,8 @@ class Hernquist(object):
 
     def density(self, r):
         rt = np.divide(r, self.a)
-        ans = np.multiply(np.power(rt, -1.), np.power(np.add(rt, 1.), -3.))
-        ans = np.multiply(ans, self.density_prefactor)
+        oneplusrt = np.add(rt, 1.)
+        ans = np.divide(self.density_prefactor, rt * oneplusrt * oneplusrt * oneplusrt)
         return ans
 
     def potential(self, r):
@@ -127,32 +291,35 @@ class Hernquist(object):
         return ans
 
     def mass_enclosed(self, r):
-        rt = np.divide(r, self.a)
-        ans = np.multiply(np.power(rt, 2.), np.add(rt, 1.), -2.)
-        ans = np.multiply(ans, self.M)
-        return ans
+        rplusa = np.add(r, self.a)
+        return np.multiply(self.M, np.divide(np.square(r), np.square(rplusa)))
+
+    def r_of_fenclosed(self, f):
+        # inverse of mass_enclosed / M, r/a = sqrt(f) / (1-sqrt(f))
+        # 1-sqrt(f) cancels catastrophically as f -> 1, so use 1-sqrt(f) = (1-f)/(1+sqrt(f))
+        # instead; 1-f is exact for f drawn in [0, 1) and never zero, so r stays finite
+        sqrtf = np.sqrt(f)
+        rt = np.divide(np.multiply(sqrtf, np.add(1., sqrtf)), np.subtract(1., f))
+        return np.multiply(rt, self.a)
 
     def _f_of_q_close_to_1_(self, q):
         # appears to be a lot wrong in this eqn in Hernquist 1990
         prefactor = 3 * self.M / (16 * np.sqrt(2) * np.pi**2 * self.a**3 * self.vg**3)
-        a = np.power(np.subtract(1., np.square(q)), 5./2.)
+        oneminusqsquared = np.subtract(1., np.square(q))
+        a = oneminusqsquared * oneminusqsquared * np.sqrt(oneminusqsquared)
         ans = np.multiply(32./(5.*np.pi), a)
         ans = np.subtract(1., ans)
         ans = np.divide(ans, a)
         return np.multiply(ans, prefactor)
 
     def f_of_q(self, q):
-        return _f_of_q(q, self.f_prefactor)
+        q = np.asarray(q, dtype=np.float64)
+        return np.reshape(_f_of_q(q.ravel(), self.f_prefactor), q.shape)
 
     def f_of_E(self, E):
-        keys = np.where(np.logical_and(E>0, E<1e-8))[0]
-        keys_ = np.where(E > 1e-2)[0]
-        if len(keys_) > 0:
-            print('E > 1e-2:', E[keys_])
-
-        E[keys] = -1e-8
-        q = self.q_of_E(E)
-        return self.f_of_q(q)
+        # clamp out of place so that the caller's E is left untouched
+        E = np.minimum(E, -1e-8)
+        return self.f_of_q(self.q_of_E(E))
     
     def f_of_vr(self, v, r=0.0):
         pot = self.potential(r)
@@ -163,38 +330,8 @@ class Hernquist(object):
         return np.multiply(self.f_of_vr(v, r), np.square(v))
 
     def g_of_q(self, q):
-        # Equation 23 of Hernquist 1990
-        qsquared = np.square(q)
-
-        # term1 = 3 * (8 * q**4 - 4 * q**2 + 1) * np.arccos(q)
-        term1 = np.multiply(8., np.square(qsquared))
-        np.subtract(term1, np.multiply(4., qsquared), out=term1)
-        np.add(term1, 1., out=term1)
-        np.multiply(term1, np.arccos(q), out=term1)
-        np.multiply(term1, 3., out=term1)
-
-
-        # term2 = q * (1 - q**2)**(1/2) *(4*q**2 - 1) * (2*q**2 + 3)
-        term2 = np.sqrt(np.subtract(1., qsquared))
-        np.multiply(term2, np.subtract(np.multiply(4., qsquared), 1.), out=term2)
-        np.multiply(term2, np.add(np.multiply(2., qsquared), 3.), out=term2)
-        np.multiply(term2, q, out=term2)
-
-        np.subtract(term1, term2, out=term1)
-        np.multiply(term1, np.power(q, -5.), out=term1)
-
-        return np.multiply(term1, self.g_prefactor)
-
-    def _dMdE_close_to_1_(self, q):
-        # appears to be a factor of 0.5 wrong in Hernquist 1990
-        prefactor = 0.5 * (32./35.) * (self.M / self.vg**2)
-        return np.multiply(prefactor, np.subtract(1., np.square(q)))
-
-    def _dMdE_close_to_0_(self, q):
-        prefactor = (16./5.) * (self.M/self.vg**2)
-        ans = np.multiply(18./7., np.square(q))
-        ans = np.subtract(1., ans)
-        return np.multiply(prefactor, ans)
+        q = np.asarray(q, dtype=np.float64)
+        return np.reshape(_g_of_q(q.ravel(), self.g_prefactor), q.shape)
 
     def dMdE(self, E, convert_to_q=True):
         # TODO: redo this because I think it's not working the way I want
@@ -204,130 +341,142 @@ class Hernquist(object):
         else:
             q = E
 
-        ans = np.multiply(self.f_of_q(q), self.g_of_q(q))
-
-        # now revert to Taylor series for q close to 1
-        keys = np.where(np.longdouble(np.subtract(1., q)) < 1e-4)[0]
-        ans[keys] = self._dMdE_close_to_1_(q[keys])
-
-        # now revert to Taylor series for q close to 0
-        keys = np.where(q < 1e-3)[0]
-        ans[keys] = self._dMdE_close_to_0_(q[keys])
-
-        return ans
+        q = np.asarray(q, dtype=np.float64)
+        ans = _dMdE_kernel(q.ravel(), self.f_prefactor, self.g_prefactor, self.M, self.vg)
+        return np.reshape(ans, q.shape)
 
     def E_of_q(self, q):
         return np.multiply(self.phi_of_0, np.square(q))
 
     def q_of_E(self, E):
-        return np.sqrt(np.divide(E, self.phi_of_0))
+        return np.sqrt(np.multiply(E, self._inv_phi_of_0_))
 
     def draw_radii(self, N):
-        f = np.random.rand(N)
-        sqrtf = np.sqrt(f)
-        
-        #f = fenclosed
-        #r/a = sqrt(f) / (1-sqrt(f))
-        
-        rt = np.divide(sqrtf, np.subtract(1., sqrtf))
-        return np.multiply(rt, self.a)
+        # f = fenclosed is uniform in [0, 1)
+        return self.r_of_fenclosed(self.rng.random(N))
+
+    def _draw_angles_(self, N):
+        # isotropic directions, cos(theta) is uniform in [-1, 1] so it is drawn directly
+        # rather than going through arccos and back
+        ctheta = np.subtract(1., np.multiply(2., self.rng.random(N)))
+        stheta = np.sqrt(np.subtract(1., np.multiply(ctheta, ctheta)))
+
+        # cos(phi), sin(phi) without trig: take points uniform in the unit disk by
+        # rejection from the square and normalise them onto the circle
+        cphi = np.empty(N)
+        sphi = np.empty(N)
+        Nfilled = 0
+        while Nfilled < N:
+            # 4/pi of the square is accepted, so overdraw slightly to usually finish in one pass
+            Ndraw = int(1.3 * (N - Nfilled)) + 16
+            u = np.subtract(np.multiply(2., self.rng.random(Ndraw)), 1.)
+            v = np.subtract(np.multiply(2., self.rng.random(Ndraw)), 1.)
+            ssq = np.add(np.multiply(u, u), np.multiply(v, v))
+
+            keys = np.where(np.logical_and(ssq <= 1., ssq > 0.))[0][:N - Nfilled]
+            s = np.sqrt(ssq[keys])
+            cphi[Nfilled:Nfilled + len(keys)] = np.divide(u[keys], s)
+            sphi[Nfilled:Nfilled + len(keys)] = np.divide(v[keys], s)
+            Nfilled += len(keys)
+
+        return ctheta, stheta, cphi, sphi
 
     def draw_coordinates(self, N):
         r = self.draw_radii(N)
 
-        theta = np.arccos(np.subtract(1., np.multiply(2., np.random.rand(N))))
-        phi = np.multiply(np.random.rand(N), 2.*np.pi)
+        ctheta, stheta, cphi, sphi = self._draw_angles_(N)
 
         # x = r * sin(theta) * cos(phi)
         # y = r * sin(theta) * sin(phi)
         # z = r * cos(theta)
-        stheta = np.sin(theta)
-        x = np.multiply(np.multiply(r, stheta), np.cos(phi))
-        y = np.multiply(np.multiply(r, stheta), np.sin(phi))
-        z =             np.multiply(r, np.cos(theta))
+        pos = np.empty((N, 3))
+        np.multiply(np.multiply(r, stheta), cphi, out=pos[:, 0])
+        np.multiply(np.multiply(r, stheta), sphi, out=pos[:, 1])
+        np.multiply(r, ctheta,                    out=pos[:, 2])
 
-        return np.transpose([x, y, z])
+        return pos
 
     def _sigmasq_(self, r):
-        prefactor = self.G * self.M / (12. * self.a)
-        rt = np.divide(r, self.a)
-        oneplusrt = np.add(1.0, rt)
-
-        # ans1 = 12 * rt * (1+rt)**3 * np.log(1+1./rt)
-        ans1 = np.log(np.add(1., np.divide(1., rt)))
-        np.multiply(ans1, np.power(oneplusrt, 3.0), out=ans1)
-        np.multiply(ans1, np.multiply(12.0, rt), out=ans1)
-
-        # ans2 = (rt/(1+rt)) * (25 + 52*rt + 42*rt**2 + 12*rt**3)
-        ans2 = np.add(25.0, np.multiply(52.0, rt))
-        np.add(ans2, np.multiply(42.0, np.square(rt)), out=ans2)
-        np.add(ans2, np.multiply(12.0, np.power(rt, 3.0)), out=ans2)
-        np.multiply(ans2, np.divide(rt, oneplusrt), out=ans2)
-
-        ans1 = np.multiply(prefactor, np.subtract(ans1, ans2))
-
-        # check if there are any nans, which just might indicate r=0
-        keys = np.where(np.isnan(ans1))
-        for i in keys:
-            if 0 <= rt[i] < 1e-12:
-                ans1[i] = 0.0
-
-        # if rt > 300, revert to the analytical form for sigma sq because the numerical eqn breaks down
-        keys = np.where(rt > 300.0)[0]
-        r_gtr = np.multiply(rt[keys], self.a)
-        ans1[keys] = np.divide(self.G*self.M/5.0, r_gtr)
-
-        return ans1
+        r = np.asarray(r, dtype=np.float64)
+        ans = _sigmasq_kernel(r.ravel(), self.a, self.G * self.M)
+        return np.reshape(ans, r.shape)
 
     def _vesc_sq_(self, r):
         ans = 2. * self.G * self.M
         return np.divide(ans, np.add(r, self.a))
 
-    def draw_energies(self, r):
-        energies = []
+    def _draw_block_seeds_(self, N):
+        # one seed per block of the numba rejection kernels, drawn from self.rng
+        Nblocks = (N + _RS_BLOCKSIZE - 1) // _RS_BLOCKSIZE
+        return self.rng.integers(0, 2**32, size=Nblocks, dtype=np.uint32)
+
+    def draw_energies(self, r, nthreads=None):
         pot_list = self.potential(r)
         maxval_list = self.f_of_E(pot_list)
-        for pot, maxval in zip(tqdm(pot_list), maxval_list):
-            sample = rejection_sample(self.f_of_E, maxval, 1, xrng=[pot, 0])
-            energies.append(float(sample))
 
-        return np.array(energies)
+        with _numba_threads(nthreads):
+            energies = _draw_energies_kernel(pot_list, maxval_list, self._inv_phi_of_0_, self.f_prefactor,
+                                             self._draw_block_seeds_(len(r)))
+
+        return energies
+
+    def _invert_cdf_row_(self, idx, u):
+        # bisect row idx of the cdf table for each u, keeping cdf[lo] <= u < cdf[hi],
+        # then invert the piecewise linear cdf within the bracketing cell
+        cdf = self._cdf_list_
+        lo = np.zeros(len(u), dtype=np.intp)
+        hi = np.full(len(u), cdf.shape[1] - 1, dtype=np.intp)
+
+        for _ in range(int(np.ceil(np.log2(cdf.shape[1] - 1)))):
+            mid = (lo + hi) // 2
+            below = cdf[idx, mid] <= u
+            lo = np.where(below, mid, lo)
+            hi = np.where(below, hi, mid)
+
+        frac = np.divide(np.subtract(u, cdf[idx, lo]), np.subtract(cdf[idx, hi], cdf[idx, lo]))
+        vfrac = self._vfrac_list_
+        return np.add(vfrac[lo], np.multiply(frac, np.subtract(vfrac[hi], vfrac[lo])))
+
+    def _draw_speeds_icdf_(self, r):
+        idx, t = self._r_grid_index_(r)
+        u = self.rng.random(len(r))
+
+        # invert the two bracketing rows and interpolate linearly in log10(r)
+        vfrac = np.add(np.multiply(np.subtract(1., t), self._invert_cdf_row_(idx, u)),
+                       np.multiply(t, self._invert_cdf_row_(idx + 1, u)))
+
+        vmax = np.sqrt(np.multiply(2., np.abs(self.potential(r))))
+        return np.multiply(vfrac, vmax)
+
+    def draw_speeds(self, r, nthreads=None, method='rejection'):
+        # method='rejection' makes exact draws; method='icdf' inverts the tabulated cdf,
+        # which needs no rejection but is only approximate, and biased for r/a << 1e-2
+        # where the 100-point v/vmax grid cannot resolve the peak of f(v|r) v^2
+        if method == 'icdf':
+            return self._draw_speeds_icdf_(r)
+        elif method != 'rejection':
+            raise ValueError("method must be 'icdf' or 'rejection'")
 
-    def _to_loop_over(self, r, vmax):
-        vlist = np.linspace(0, vmax, 100)
-        maxval = np.nanmax(self.my_f_of_vr(vlist, r)) * 2
-        sample = rejection_sample(self.my_f_of_vr, maxval, 1, xrng=[0, vmax], fn_args={'r': r})
-        return float(sample)
-    
-    def draw_speeds(self, r, nthreads=1):
-        speeds = []
         pot_list = self.potential(r)
         vmax_list = np.sqrt(np.multiply(2., np.abs(pot_list)))
 
-#         maxval_list = self.my_f_of_vr(vmax_list/2., r) * 10
-        
-        maxval_list = self._maxval_interp_(r)
+        with _numba_threads(nthreads):
+            speeds = _draw_speeds_kernel(r, pot_list, vmax_list, self._log10rmin_, self._dlog10r_,
+                                         self._maxval_list_, self._inv_phi_of_0_, self.f_prefactor,
+                                         self._draw_block_seeds_(len(r)))
 
-#         speeds = Parallel(n_jobs=nthreads) (delayed(self._to_loop_over)(r, vmax) for r, vmax in zip(tqdm(r), vmax_list))
-        
-        for this_r, vmax, maxval in zip(tqdm(r), vmax_list, maxval_list):
-#             vlist = np.linspace(0, vmax, 100)
-#             maxval = np.nanmax(self.my_f_of_vr(vlist, this_r)) * 2
-            sample = rejection_sample(self.my_f_of_vr, maxval, 1, xrng=[0, vmax], fn_args={'r': this_r})
-            speeds.append(float(sample))
-
-        return np.array(speeds)
+        return speeds
 
     def old_draw_velocities(self, pos):
-        r = np.linalg.norm(pos, axis=1)
+        r = np.sqrt(np.einsum('ij,ij->i', pos, pos))
 
         N = len(r)
         mean = np.zeros(N)
         sigma = np.sqrt(self._sigmasq_(r))
 
-        vr = np.random.normal(mean, sigma)
-        vphi = np.random.normal(mean, sigma)
-        vtheta = np.random.normal(mean, sigma)
+        vr = self.rng.normal(mean, sigma)
+        vphi = self.rng.normal(mean, sigma)
+        vtheta = self.rng.normal(mean, sigma)
 
         # redraw any which exceed 0.95 * vesc
         velsq = np.add(np.add(np.square(vr), np.square(vphi)), np.square(vtheta))
@@ -336,7 +485,7 @@ class Hernquist(object):
         for i in keys:
             vmagsq = vesc_sq[i]
             while(vmagsq > 0.95 * vesc_sq[i]):
-                vr_, vphi_, vtheta_ = np.random.normal(mean[i], sigma[i], size=3)
+                vr_, vphi_, vtheta_ = self.rng.normal(mean[i], sigma[i], size=3)
                 vmagsq = vr_**2 + vphi_**2 + vtheta_**2
             vr[i] = vr_
             vphi[i] = vphi_
@@ -348,24 +497,23 @@ class Hernquist(object):
         # so for now, since isotropic, can just substitute vx=vr, vy=...
         return np.transpose([vr, vphi, vtheta])
 
-    def draw_velocities(self, pos, nthreads=1):
-        r = np.linalg.norm(pos, axis=1)
+    def draw_velocities(self, pos, nthreads=None):
+        r = np.sqrt(np.einsum('ij,ij->i', pos, pos))
         N = len(r)
 
         speeds = self.draw_speeds(r, nthreads=nthreads)
 
-        theta = np.arccos(np.subtract(1., np.multiply(2., np.random.rand(N))))
-        phi = np.multiply(np.random.rand(N), 2.*np.pi)
+        ctheta, stheta, cphi, sphi = self._draw_angles_(N)
 
         # vx = v * sin(theta) * cos(phi)
         # vy = v * sin(theta) * sin(phi)
         # vz = v * cos(theta)
-        stheta = np.sin(theta)
-        vx = np.multiply(np.multiply(speeds, stheta), np.cos(phi))
-        vy = np.multiply(np.multiply(speeds, stheta), np.sin(phi))
-        vz =             np.multiply(speeds, np.cos(theta))
-        
-        return np.transpose([vx, vy, vz])
+        vel = np.empty((N, 3))
+        np.multiply(np.multiply(speeds, stheta), cphi, out=vel[:, 0])
+        np.multiply(np.multiply(speeds, stheta), sphi, out=vel[:, 1])
+        np.multiply(speeds, ctheta,                    out=vel[:, 2])
+
+        return vel
 
     def gen_ics(self, N, fname):
         if not HAVE_AREPO: